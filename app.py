@@ -1,170 +1,119 @@
 import logging
-import os
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 import streamlit.components.v1 as components
-from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import PromptTemplate
 
-# from langchain_gigachat import GigaChat
-from langchain_community.chat_models import GigaChat
-from io import BytesIO
-from docx import Document
-from docx.shared import Pt
-
-
-def load_template(type):
-    """
-    Загружает текст запроса для LLM.
-    """
-    if type == "changes":
-        with open("prompt_changes.txt", "r", encoding="utf-8") as file:
-            template = file.read()
-    else:
-        with open("prompt_new_federal_law.txt", "r", encoding="utf-8") as file:
-            template = file.read()
-
-    return template
+from law_assistant.core import (
+    MODEL_MAP,
+    PROMPT_FILES,
+    SCOPE_MAP,
+    build_docx,
+    cache_analysis,
+    extract_text_from_file,
+    get_analysis_key,
+    get_llm,
+    get_prompt,
+    hash_api_key,
+    parse_combined_analysis,
+    prune_region_law,
+    render_combined_analysis,
+    stream_in_background,
+    stream_markdown,
+)
+
+# Streamlit перезапускает скрипт при каждом действии пользователя,
+# логирование достаточно настроить один раз
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO)
 
 
-def get_model(model_name: str) -> str:
+def warm_up_resources():
     """
-    Возвращает модель GigaChat в зависимости от выбранного имени модели.
-
-    Args:
-        model_name (str): Имя модели GigaChat.
-
-    Returns:
-        str: Имя модели API GigaChat.
+    Заранее загружает шаблоны запросов при первом открытии страницы,
+    чтобы не тратить на это время после запуска анализа.
     """
-    models = {
-        "GigaChat-2": "GigaChat-2",
-        "GigaChat-2-Pro": "GigaChat-2-Pro",
-        "GigaChat-2-Max": "GigaChat-2-Max",
-    }
-    return models[model_name]
+    for type in PROMPT_FILES:
+        get_prompt(type)
 
 
 def create_files_upload_section():
     """
     Создает секцию загрузки файлов и выбора модели/версии API.
+    Виджеты объединены в форму, поэтому скрипт перезапускается только
+    при отправке формы, а не при каждом изменении поля.
     """
-    # Добавляем поле для ввода API ключа GigaChat
-    api_key = st.text_input(
-        "🔑 API ключ GigaChat", type="password", help="Введите ваш API ключ GigaChat"
-    )
-    st.session_state.api_key = api_key
-
-    # Выбор модели
-    model_name = st.selectbox(
-        "Выберите модель GigaChat",
-        [
-            "GigaChat-2 ⚡",
-            "GigaChat-2-Pro ⚡⚡",
-            "GigaChat-2-Max ⚡⚡⚡",
-        ],
-        index=0,
-    )
-    # Приводим к ключу для get_model
-    model_key = model_name.split(" ")[0]
-    st.session_state.model = get_model(model_key)
-
-    # Выбор scope
-    scope = st.selectbox(
-        "Выберите версию API",
-        [
-            "GIGACHAT_API_PERS (для физических лиц)",
-            "GIGACHAT_API_CORP (для юридических лиц)",
-            "GIGACHAT_API_B2B (для бизнеса)",
-        ],
-        index=0,
-    ).split(" ")[0]
-    st.session_state.scope = scope
-
-    changes = st.file_uploader(
-        "📄 Загрузите изменения закона (старая и новая версии)", ["pdf", "docx"]
-    )
-    new_federal_law = st.file_uploader(
-        "📝 Загрузите обновленный закон РФ", ["pdf", "docx"]
-    )
-    region_law = st.file_uploader(
-        "📝 Загрузите закон Курганской области", ["pdf", "docx"]
-    )
-    return changes, new_federal_law, region_law
-
-
-def save_file(file, name=None):
-    """
-    Сохраняет загруженный файл с уникальным идентификатором.
-    """
-    unique_id = str(uuid.uuid4())
-    file_name = f"{unique_id}_{name if name else file.name}"
-    with open(file_name, "wb") as f:
-        f.write(file.getbuffer())
-    return file_name
-
-
-def save_uploaded_files(files_to_save):
+    with st.form("inputs"):
+        # Добавляем поле для ввода API ключа GigaChat
+        api_key = st.text_input(
+            "🔑 API ключ GigaChat",
+            type="password",
+            help="Введите ваш API ключ GigaChat",
+        )
+        st.session_state.api_key = api_key
+
+        # Выбор модели
+        model_name = st.selectbox("Выберите модель GigaChat", MODEL_MAP, index=0)
+        st.session_state.model = MODEL_MAP[model_name]
+
+        # Выбор scope
+        scope_name = st.selectbox("Выберите версию API", SCOPE_MAP, index=0)
+        st.session_state.scope = SCOPE_MAP[scope_name]
+
+        changes = st.file_uploader(
+            "📄 Загрузите изменения закона (старая и новая версии)", ["pdf", "docx"]
+        )
+        new_federal_law = st.file_uploader(
+            "📝 Загрузите обновленный закон РФ", ["pdf", "docx"]
+        )
+        region_law = st.file_uploader(
+            "📝 Загрузите закон Курганской области", ["pdf", "docx"]
+        )
+
+        # Сокращение закона Курганской области перед отправкой в LLM
+        st.session_state.region_law_fragments = st.number_input(
+            "✂️ Количество фрагментов закона Курганской области",
+            min_value=0,
+            value=0,
+            step=10,
+            help=(
+                "В запрос попадут только фрагменты закона, наиболее близкие к "
+                "федеральным документам. 0 — передать закон целиком."
+            ),
+        )
+
+        start_check = st.form_submit_button("🔍 Выполнить анализ изменений")
+    return changes, new_federal_law, region_law, start_check
+
+
+@st.fragment
+def create_download_section():
     """
-    Сохраняет загруженные файлы.
+    Создает секцию скачивания результата анализа в формате DOCX.
+    Документ формируется только по запросу пользователя; кнопка перезапускает
+    лишь этот фрагмент, поэтому результаты анализа остаются на странице.
     """
-    saved_files = {}
-    for key, file in files_to_save.items():
-        if file:
-            saved_files[key] = save_file(file)
-    return saved_files
-
-
-def delete_files(files):
-    """
-    Удаляет загруженные файлы.
-    """
-    try:
-        for file in files:
-            if file:
-                os.remove(file)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении файлов: {str(e)}")
-
-
-def extract_text_from_file(uploaded_file: str) -> str:
-    """
-    Извлекает текстовое содержимое из файлов PDF, DOCX.
-    """
-    try:
-        if uploaded_file.endswith(".docx"):
-            return Docx2txtLoader(uploaded_file).load()[0].page_content
-        elif uploaded_file.endswith(".pdf"):
-            return PyPDFLoader(uploaded_file, mode="single").load()[0].page_content
-        return ""  # Возвращаем пустую строку для неподдерживаемых форматов
-    except Exception as e:
-        logging.error(f"Ошибка при чтении файла {uploaded_file}: {str(e)}")
-        st.error(f"Ошибка при чтении файла {uploaded_file}")
-        return ""  # Возвращаем пустую строку в случае ошибки
-
-
-def build_docx(text: str) -> BytesIO:
-    doc = Document()
-    style = doc.styles["Normal"]
-    font = style.font
-    font.name = "Times New Roman"
-    font.size = Pt(12)
-
-    # Разбиваем текст на абзацы по переносам строк
-    for paragraph in text.strip().split("\n"):
-        doc.add_paragraph(paragraph)
-
-    buffer = BytesIO()
-    doc.save(buffer)
-    buffer.seek(0)
-    return buffer
+    if st.button("📄 Подготовить DOCX"):
+        try:
+            docx_file = build_docx(st.session_state.analysis)
+        except Exception as e:
+            logging.error(f"При формировании DOCX возникла ошибка: {str(e)}")
+            st.error(
+                "При формировании DOCX возникла ошибка. Пожалуйста попробуйте снова."
+            )
+            return
+        st.download_button(
+            label="💾 Скачать как DOCX",
+            data=docx_file,
+            file_name="project_kurgan_changes.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            on_click="ignore",
+        )
 
 
 def main():
-    logging.basicConfig(level=logging.INFO)
-
     st.title("Ассистент для анализа изменений в законах")
 
     yandex_code = """
@@ -183,9 +132,8 @@ def main():
         """
     components.html(yandex_code, height=0)
 
-    changes, new_federal_law, region_law = create_files_upload_section()
-
-    start_check = st.button("🔍 Выполнить анализ изменений")
+    changes, new_federal_law, region_law, start_check = create_files_upload_section()
+    warm_up_resources()
 
     if start_check:
         # Проверяем наличие API ключа
@@ -194,78 +142,100 @@ def main():
             return
 
         if (changes or new_federal_law) and region_law:
-            # Сохранение загруженных файлов
-            files_to_save = {
-                "changes": changes,
-                "new_federal_law": new_federal_law,
-                "region_law": region_law,
-            }
-            saved_files = save_uploaded_files(files_to_save)
+            # Извлечение текста из файлов; документы независимы и читаются
+            # параллельно. Для PDF это дает чередование, а не ускорение:
+            # вызовы PDFium выполняются по одному (см. pdf_pages). Потокам
+            # передается контекст сессии Streamlit, чтобы st.error из
+            # extract_text_from_file выводился на странице
+            with ThreadPoolExecutor(
+                max_workers=3,
+                initializer=add_script_run_ctx,
+                initargs=(None, get_script_run_ctx()),
+            ) as executor:
+                futures = [
+                    executor.submit(extract_text_from_file, file) if file else None
+                    for file in (changes, new_federal_law, region_law)
+                ]
+                changes_text, new_federal_law_text, region_law_text = (
+                    future.result() if future else "" for future in futures
+                )
 
-            # Извлечение текста из файлов
-            changes_text = (
-                extract_text_from_file(saved_files.get("changes", ""))
-                if changes
-                else ""
-            )
-            new_federal_law_text = (
-                extract_text_from_file(saved_files.get("new_federal_law", ""))
-                if new_federal_law
-                else ""
-            )
-            region_law_text = (
-                extract_text_from_file(saved_files.get("region_law", ""))
-                if region_law
-                else ""
+            region_law_text = prune_region_law(
+                region_law_text,
+                f"{changes_text}\n{new_federal_law_text}",
+                st.session_state.region_law_fragments,
             )
 
-            # Загрузка текста запроса для LLM
-            if changes_text:
-                prompt = PromptTemplate.from_template(load_template("changes"))
+            # Загрузка текста запроса для LLM. Если загружены и изменения,
+            # и новый закон РФ, оба анализа выполняются одним запросом,
+            # чтобы закон Курганской области передавался модели один раз
+            combined = bool(changes_text and new_federal_law_text)
+            if combined:
+                prompt = get_prompt("combined")
+                input_dict = {
+                    "changes": changes_text,
+                    "new_federal_law": new_federal_law_text,
+                    "region_law": region_law_text,
+                }
+            elif changes_text:
+                prompt = get_prompt("changes")
                 input_dict = {"changes": changes_text, "region_law": region_law_text}
             else:
-                prompt = PromptTemplate.from_template(load_template("new_federal_law"))
+                prompt = get_prompt("new_federal_law")
                 input_dict = {
                     "new_federal_law": new_federal_law_text,
                     "region_law": region_law_text,
                 }
 
-            llm = GigaChat(
-                model=st.session_state.model,
-                credentials=st.session_state.api_key,
-                scope=st.session_state.scope,
-                verify_ssl_certs=False,
-                temperature=0.1,
-                top_p=0.8,
-                timeout=1000,
-                streaming=True,
+            llm = get_llm(
+                st.session_state.model,
+                st.session_state.scope,
+                hash_api_key(st.session_state.api_key),
+                st.session_state.api_key,
             )
 
             chain = prompt | llm | StrOutputParser()
 
             output_spot = st.empty()
-            partial = ""
+
+            # Результаты кэшируются по содержимому запроса, чтобы повторный
+            # анализ тех же документов не обращался к LLM
+            analysis_key = get_analysis_key(
+                prompt.template,
+                input_dict,
+                st.session_state.model,
+                st.session_state.scope,
+            )
+            analysis_cache = st.session_state.setdefault("analysis_cache", {})
 
             try:
-                with st.spinner("Выполняется анализ изменений..."):
-                    for chunk in chain.stream(input_dict):
-                        partial += chunk
+                # Ответ на объединенный запрос — JSON-массив, поэтому он не
+                # выводится по мере получения, а разбирается после завершения
+                if analysis_key in analysis_cache:
+                    partial = analysis_cache[analysis_key]
+                    if not combined:
                         output_spot.markdown(partial)
+                else:
+                    with st.spinner("Выполняется анализ изменений..."):
+                        chunks = stream_in_background(chain.stream(input_dict))
+                        if combined:
+                            partial = "".join(chunks)
+                        else:
+                            partial = stream_markdown(chunks, output_spot)
+                sections = parse_combined_analysis(partial) if combined else []
+                # Пустой ответ и неразобранный ответ на объединенный запрос не
+                # кэшируются, чтобы повторный запуск снова обратился к LLM
+                if partial and (sections or not combined):
+                    cache_analysis(analysis_cache, analysis_key, partial)
+                if combined:
+                    partial = render_combined_analysis(partial, sections, output_spot)
                 st.header("Результаты анализа", divider=True)
-                docx_file = build_docx(partial)
-                st.download_button(
-                    label="💾 Скачать как DOCX",
-                    data=docx_file,
-                    file_name="project_kurgan_changes.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                )
+                st.session_state.analysis = partial
+                create_download_section()
             except Exception as e:
                 logging.error(f"При анализе возникла ошибка: {str(e)}")
                 st.error("При анализе возникла ошибка. Пожалуйста попробуйте снова.")
 
-            finally:
-                delete_files(saved_files.values())
-
         # Обработка случаев, когда необходимые файлы не загружены
         elif region_law:
             msg = "⚠️ Перед запуском необходимо загрузить изменения закона или новый закон РФ"
@@ -0,0 +1,3 @@
+"""
+Ассистент для анализа изменений в законах.
+"""
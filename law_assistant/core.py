@@ -0,0 +1,462 @@
+"""
+Общие функции ассистента: загрузка запросов и клиента GigaChat, извлечение
+текста из документов, подготовка запроса, вывод ответа и формирование DOCX.
+"""
+
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from queue import Queue
+
+import docx2txt
+import orjson
+import streamlit as st
+from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader
+from langchain_core.prompts import PromptTemplate
+
+# from langchain_gigachat import GigaChat
+from langchain_community.chat_models import GigaChat
+from io import BytesIO
+from docx import Document
+from docx.oxml.ns import qn
+from docx.shared import Pt
+from lxml import etree
+from rank_bm25 import BM25Okapi
+
+from law_assistant.pdf_pages import extract_pdf_text
+
+# Параметры пакетной перерисовки потокового ответа LLM
+STREAM_MIN_BATCH_SIZE = 20  # символов до первой перерисовки
+STREAM_MAX_BATCH_SIZE = 200  # предельный размер пакета в символах
+STREAM_BATCH_GROWTH_FACTOR = 2
+STREAM_FLUSH_INTERVAL = 0.05  # секунд между перерисовками
+STREAM_END = object()  # признак завершения потока ответа LLM
+
+SAVE_FILE_CHUNK_SIZE = 1024 * 1024  # размер блока записи файла на диск
+_save_counter = itertools.count()  # счетчик для имен сохраняемых файлов
+
+REGION_LAW_WINDOW_LINES = 8  # непустых строк во фрагменте закона
+TOKEN_RE = re.compile(r"\w+")
+REGION_LAW_OMISSION = "[…]"  # отметка пропущенной части закона
+REGION_LAW_EXCERPT_NOTE = (
+    "Закон приведен выдержками: пропущенные части отмечены […]. Отсутствие "
+    "положения в выдержках не означает его отсутствия в законе."
+)
+
+# Тип запроса -> файл с текстом запроса для LLM
+PROMPT_FILES = {
+    "changes": "prompt_changes.txt",
+    "new_federal_law": "prompt_new_federal_law.txt",
+    "combined": "prompt_combined.txt",
+}
+
+# Заголовки разделов ответа на объединенный запрос, в порядке задач
+COMBINED_SECTIONS = (
+    "Анализ изменений закона",
+    "Анализ обновленного закона РФ",
+)
+
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+RUN_SPECIAL_CHARS_RE = re.compile(r"([\t\r])")
+
+LLM_CACHE_SIZE = 32  # число одновременно хранимых клиентов GigaChat
+ANALYSIS_CACHE_SIZE = 8  # число хранимых в сессии результатов анализа
+
+# Отображаемое имя модели GigaChat -> имя модели API GigaChat
+MODEL_MAP = {
+    "GigaChat-2 ⚡": "GigaChat-2",
+    "GigaChat-2-Pro ⚡⚡": "GigaChat-2-Pro",
+    "GigaChat-2-Max ⚡⚡⚡": "GigaChat-2-Max",
+}
+
+# Отображаемое название версии API -> scope API GigaChat
+SCOPE_MAP = {
+    "GIGACHAT_API_PERS (для физических лиц)": "GIGACHAT_API_PERS",
+    "GIGACHAT_API_CORP (для юридических лиц)": "GIGACHAT_API_CORP",
+    "GIGACHAT_API_B2B (для бизнеса)": "GIGACHAT_API_B2B",
+}
+
+
+@functools.lru_cache(maxsize=4)
+def load_template(type):
+    """
+    Загружает текст запроса для LLM.
+    Файлы запросов не меняются во время работы, поэтому результат кэшируется.
+    """
+    with open(PROMPT_FILES[type], "r", encoding="utf-8") as file:
+        template = file.read()
+
+    return template
+
+
+@st.cache_resource
+def get_prompt(type) -> PromptTemplate:
+    """
+    Возвращает разобранный шаблон запроса для LLM, общий для всех сессий.
+    """
+    return PromptTemplate.from_template(load_template(type))
+
+
+def hash_api_key(api_key: str) -> str:
+    """
+    Возвращает хэш API ключа для использования в ключе кэша.
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+@st.cache_resource(max_entries=LLM_CACHE_SIZE)
+def get_llm(model: str, scope: str, api_key_hash: str, _api_key: str) -> GigaChat:
+    """
+    Создает клиент GigaChat и переиспользует его между запусками анализа,
+    сохраняя HTTP-соединения и токен доступа.
+
+    Args:
+        model (str): Имя модели API GigaChat.
+        scope (str): Версия API GigaChat.
+        api_key_hash (str): Хэш API ключа, по которому кэшируется клиент.
+        _api_key (str): API ключ GigaChat; не участвует в ключе кэша.
+
+    Returns:
+        GigaChat: Клиент GigaChat.
+    """
+    return GigaChat(
+        model=model,
+        credentials=_api_key,
+        scope=scope,
+        verify_ssl_certs=False,
+        temperature=0.1,
+        top_p=0.8,
+        timeout=1000,
+        streaming=True,
+    )
+
+
+def save_file(file, name=None):
+    """
+    Сохраняет загруженный файл с уникальным идентификатором.
+    Идентификатор составлен из номера процесса и счетчика сохранений.
+    """
+    file_name = f"{os.getpid()}_{next(_save_counter)}_{name if name else file.name}"
+    # Файл копируется блоками, чтобы не держать в памяти вторую копию
+    file.seek(0)
+    with open(file_name, "wb") as f:
+        shutil.copyfileobj(file, f, length=SAVE_FILE_CHUNK_SIZE)
+    return file_name
+
+
+def delete_files(files):
+    """
+    Удаляет загруженные файлы.
+    """
+    try:
+        for file in files:
+            if file:
+                os.remove(file)
+    except Exception as e:
+        logging.error(f"Ошибка при удалении файлов: {str(e)}")
+
+
+def extract_text_from_saved_file(uploaded_file) -> str:
+    """
+    Извлекает текст через загрузчики LangChain, которым нужен путь к файлу.
+    Загруженный файл временно сохраняется на диск и удаляется после чтения.
+    """
+    saved_file = save_file(uploaded_file)
+    try:
+        if saved_file.endswith(".docx"):
+            return Docx2txtLoader(saved_file).load()[0].page_content
+        elif saved_file.endswith(".pdf"):
+            return PyPDFLoader(saved_file, mode="single").load()[0].page_content
+        return ""  # Возвращаем пустую строку для неподдерживаемых форматов
+    except Exception as e:
+        logging.error(f"Ошибка при чтении файла {uploaded_file.name}: {str(e)}")
+        st.error(f"Ошибка при чтении файла {uploaded_file.name}")
+        return ""  # Возвращаем пустую строку в случае ошибки
+    finally:
+        delete_files([saved_file])
+
+
+def extract_text_from_file(uploaded_file) -> str:
+    """
+    Извлекает текстовое содержимое из файлов PDF, DOCX.
+    Файл читается из памяти без сохранения на диск; при ошибке выполняется
+    повторная попытка через extract_text_from_saved_file.
+    """
+    try:
+        if uploaded_file.name.endswith(".docx"):
+            return docx2txt.process(BytesIO(uploaded_file.getbuffer()))
+        elif uploaded_file.name.endswith(".pdf"):
+            return extract_pdf_text(uploaded_file.getbuffer())
+        return ""  # Возвращаем пустую строку для неподдерживаемых форматов
+    except Exception as e:
+        logging.warning(
+            f"Не удалось прочитать файл {uploaded_file.name} из памяти: {str(e)}"
+        )
+        return extract_text_from_saved_file(uploaded_file)
+
+
+def tokenize(text: str) -> list:
+    """
+    Разбивает текст на слова в нижнем регистре для поиска BM25.
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+def prune_region_law(region_law_text: str, query_text: str, top_k: int) -> str:
+    """
+    Оставляет в законе Курганской области только фрагменты, наиболее
+    релевантные федеральным документам.
+
+    Закон разбивается на фрагменты по REGION_LAW_WINDOW_LINES непустых строк,
+    фрагменты ранжируются BM25 по тексту федеральных документов, и выбранные
+    фрагменты возвращаются в исходном порядке. Пропуски между ними отмечаются
+    REGION_LAW_OMISSION, а перед текстом добавляется REGION_LAW_EXCERPT_NOTE,
+    чтобы модель не считала пропущенные положения отсутствующими в законе.
+
+    Args:
+        region_law_text (str): Текст закона Курганской области.
+        query_text (str): Текст федеральных документов.
+        top_k (int): Количество оставляемых фрагментов; 0 — закон целиком.
+
+    Returns:
+        str: Сокращенный текст закона.
+    """
+    if top_k <= 0:
+        return region_law_text
+
+    lines = [line for line in region_law_text.splitlines() if line.strip()]
+    windows = [
+        "\n".join(lines[i : i + REGION_LAW_WINDOW_LINES])
+        for i in range(0, len(lines), REGION_LAW_WINDOW_LINES)
+    ]
+    if len(windows) <= top_k:
+        return region_law_text
+
+    bm25 = BM25Okapi([tokenize(window) for window in windows])
+    # Слова запроса, которых нет в законе, не влияют на оценку
+    query = [token for token in set(tokenize(query_text)) if token in bm25.idf]
+    scores = bm25.get_scores(query)
+    top = sorted(heapq.nlargest(top_k, range(len(windows)), key=scores.__getitem__))
+    logging.info(
+        f"Закон Курганской области сокращен до {top_k} из {len(windows)} фрагментов"
+    )
+    parts = [REGION_LAW_EXCERPT_NOTE]
+    previous = -1
+    for i in top:
+        if i != previous + 1:
+            parts.append(REGION_LAW_OMISSION)
+        parts.append(windows[i])
+        previous = i
+    if previous != len(windows) - 1:
+        parts.append(REGION_LAW_OMISSION)
+    return "\n".join(parts)
+
+
+def build_docx(text: str) -> BytesIO:
+    doc = Document()
+    style = doc.styles["Normal"]
+    font = style.font
+    font.name = "Times New Roman"
+    font.size = Pt(12)
+
+    # Разбиваем текст на абзацы по переносам строк. Абзацы собираются
+    # напрямую в XML отдельно от документа и добавляются в тело одной
+    # операцией, а не через doc.add_paragraph для каждой строки
+    paragraphs = []
+    for paragraph in text.strip().split("\n"):
+        p = etree.Element(qn("w:p"))
+        paragraphs.append(p)
+        if paragraph:
+            r = etree.SubElement(p, qn("w:r"))
+            # Как и run.text, табуляция становится w:tab, а \r — переносом w:br
+            for part in RUN_SPECIAL_CHARS_RE.split(paragraph):
+                if part == "\t":
+                    etree.SubElement(r, qn("w:tab"))
+                elif part == "\r":
+                    etree.SubElement(r, qn("w:br"))
+                elif part:
+                    t = etree.SubElement(r, qn("w:t"))
+                    t.text = part
+                    if part != part.strip():
+                        t.set(XML_SPACE, "preserve")
+    # Свойства раздела должны оставаться последним элементом тела документа
+    body = doc.element.body
+    sect_pr = body.sectPr
+    if sect_pr is not None:
+        body.remove(sect_pr)
+    body.extend(paragraphs)
+    if sect_pr is not None:
+        body.append(sect_pr)
+
+    buffer = BytesIO()
+    doc.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def stream_in_background(chunks):
+    """
+    Читает поток ответа LLM в отдельном потоке и отдает полученные части.
+
+    Пока страница перерисовывается, чтение и разбор ответа продолжаются
+    в фоне. Ошибка чтения потока пробрасывается вызывающему коду. Если
+    вызывающий код перестает читать ответ (перезапуск или остановка скрипта),
+    фоновое чтение прекращается и поток ответа LLM закрывается.
+    """
+    chunk_queue = Queue()
+    stopped = threading.Event()
+
+    def read_stream():
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    chunks.close()
+                    break
+                chunk_queue.put(chunk)
+        except Exception as e:
+            chunk_queue.put(e)
+        chunk_queue.put(STREAM_END)
+
+    threading.Thread(target=read_stream, daemon=True).start()
+    try:
+        while (chunk := chunk_queue.get()) is not STREAM_END:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stopped.set()
+
+
+def stream_markdown(chunks, output_spot) -> str:
+    """
+    Выводит потоковый ответ LLM, перерисовывая Markdown пакетами.
+
+    Перерисовка выполняется, когда накопилось не меньше текущего размера
+    пакета символов или истек интервал STREAM_FLUSH_INTERVAL. Размер пакета
+    начинается с малого значения, чтобы первый текст появлялся быстро,
+    и растет до STREAM_MAX_BATCH_SIZE.
+
+    Returns:
+        str: Полный текст ответа.
+    """
+    # Части ответа склеиваются только в момент перерисовки
+    parts = []
+    batch_size = STREAM_MIN_BATCH_SIZE
+    pending = 0
+    last_flush = time.monotonic()
+    for chunk in chunks:
+        parts.append(chunk)
+        pending += len(chunk)
+        now = time.monotonic()
+        if pending >= batch_size or now - last_flush >= STREAM_FLUSH_INTERVAL:
+            output_spot.markdown("".join(parts))
+            pending = 0
+            last_flush = now
+            batch_size = min(
+                batch_size * STREAM_BATCH_GROWTH_FACTOR, STREAM_MAX_BATCH_SIZE
+            )
+    # Выводим оставшийся хвост ответа
+    text = "".join(parts)
+    output_spot.markdown(text)
+    return text
+
+
+def get_analysis_key(template: str, input_dict: dict, model: str, scope: str) -> str:
+    """
+    Возвращает ключ кэша результата анализа — BLAKE2b-хэш запроса к LLM.
+    """
+    payload = orjson.dumps(
+        [template, input_dict, model, scope], option=orjson.OPT_SORT_KEYS
+    )
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def cache_analysis(analysis_cache: dict, key: str, text: str):
+    """
+    Сохраняет ответ LLM в кэше сессии, вытесняя самые старые записи.
+    """
+    analysis_cache.pop(key, None)
+    analysis_cache[key] = text
+    while len(analysis_cache) > ANALYSIS_CACHE_SIZE:
+        del analysis_cache[next(iter(analysis_cache))]
+
+
+def parse_combined_analysis(text: str) -> list:
+    """
+    Разбирает ответ LLM на объединенный запрос — JSON-массив из двух анализов.
+
+    Returns:
+        list: Тексты анализов в порядке COMBINED_SECTIONS или пустой список,
+        если ответ не удалось разобрать.
+    """
+    # Ответ без обрамления разбирается сразу
+    try:
+        sections = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        sections = None
+    if is_combined_sections(sections):
+        return sections
+
+    # Модель может обернуть массив в пояснения или разметку кода и упомянуть
+    # задачи как [1], [2], поэтому массив ищется с каждой открывающей скобки.
+    # strict=False допускает настоящие переносы строк внутри строк JSON,
+    # которые orjson отвергает
+    decoder = json.JSONDecoder(strict=False)
+    start = text.find("[")
+    while start != -1:
+        try:
+            sections, _ = decoder.raw_decode(text, start)
+        except ValueError:
+            sections = None
+        if is_combined_sections(sections):
+            return sections
+        start = text.find("[", start + 1)
+    return []
+
+
+def is_combined_sections(sections) -> bool:
+    """
+    Проверяет, что разобранный JSON — список анализов для COMBINED_SECTIONS.
+    """
+    return (
+        isinstance(sections, list)
+        and len(sections) == len(COMBINED_SECTIONS)
+        and all(isinstance(section, str) for section in sections)
+    )
+
+
+def render_combined_analysis(text: str, sections: list, output_spot) -> str:
+    """
+    Выводит ответ на объединенный запрос отдельными разделами.
+
+    Args:
+        text (str): Ответ LLM на объединенный запрос.
+        sections (list): Результат parse_combined_analysis для этого ответа.
+        output_spot: Место вывода результата на странице.
+
+    Returns:
+        str: Текст результата с заголовками разделов; исходный ответ,
+        если его не удалось разобрать.
+    """
+    if not sections:
+        logging.warning("Не удалось разобрать ответ на объединенный запрос")
+        with output_spot.container():
+            st.warning("⚠️ Не удалось разделить ответ на разделы, показан ответ модели")
+            st.text(text)
+        return text
+
+    with output_spot.container():
+        for title, section in zip(COMBINED_SECTIONS, sections):
+            st.subheader(title)
+            st.markdown(section)
+    return "\n\n".join(
+        f"{title}\n\n{section}" for title, section in zip(COMBINED_SECTIONS, sections)
+    )
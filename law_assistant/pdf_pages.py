@@ -0,0 +1,137 @@
+"""
+Извлечение текста из PDF.
+
+Основной способ — PDFium (pypdfium2); документы, которые PDFium не открывает,
+обрабатываются pypdf с распределением страниц между процессами. Модуль
+импортируется процессами пула заново, поэтому зависит только от библиотек PDF.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import pypdfium2 as pdfium
+from pypdf import PdfReader
+
+# Документы с меньшим числом страниц обрабатываются в текущем процессе:
+# запуск пула (около секунды на spawn процессов) обходится дороже их извлечения
+PARALLEL_MIN_PAGES = 100
+PARALLEL_MAX_WORKERS = 4  # предельное число процессов пула
+
+# Одновременно работает не больше одного пула; документы, для которых пул
+# занят, обрабатываются в текущем процессе, поэтому общее число процессов
+# не превышает PARALLEL_MAX_WORKERS
+_pool_lock = threading.Lock()
+
+# PDFium не поддерживает одновременные вызовы из нескольких потоков,
+# а документы извлекаются параллельно и в разных сессиях. Блокировка
+# берется на открытие, закрытие и каждую страницу, а не на весь документ,
+# чтобы извлечение разных документов чередовалось
+_pdfium_lock = threading.Lock()
+
+# PdfReader, открытый в процессе пула
+_reader = None
+
+
+def _init_worker(data: bytes):
+    """
+    Открывает PDF один раз при запуске процесса пула.
+    """
+    global _reader
+    _reader = PdfReader(BytesIO(data))
+
+
+def _extract_pages(pages: range) -> list:
+    """
+    Извлекает текст из диапазона страниц PDF, открытого в процессе пула.
+    """
+    return [_reader.pages[i].extract_text() for i in pages]
+
+
+def extract_pdfium_text(data: bytes) -> str:
+    """
+    Извлекает текст из PDF с помощью PDFium.
+
+    Args:
+        data (bytes): Содержимое PDF-файла.
+
+    Returns:
+        str: Текст всех страниц, разделенный переносами строк.
+    """
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(data)
+        page_count = len(pdf)
+    texts = []
+    try:
+        for i in range(page_count):
+            with _pdfium_lock:
+                page = pdf[i]
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+    finally:
+        with _pdfium_lock:
+            pdf.close()
+    # PDFium разделяет строки символами \r\n
+    return "\n".join(texts).replace("\r\n", "\n")
+
+
+def extract_pypdf_text(data: bytes) -> str:
+    """
+    Извлекает текст из PDF с помощью pypdf, распределяя страницы между процессами.
+
+    Args:
+        data (bytes): Содержимое PDF-файла.
+
+    Returns:
+        str: Текст всех страниц, разделенный переносами строк.
+    """
+    reader = PdfReader(BytesIO(data))
+    page_count = len(reader.pages)
+    workers = min(os.cpu_count() or 1, PARALLEL_MAX_WORKERS)
+    if (
+        page_count < PARALLEL_MIN_PAGES
+        or workers < 2
+        or not _pool_lock.acquire(blocking=False)
+    ):
+        return "\n".join(page.extract_text() for page in reader.pages)
+
+    # Каждому процессу достается непрерывный диапазон страниц, поэтому
+    # содержимое файла передается и разбирается один раз на процесс
+    step = -(-page_count // workers)
+    chunks = [range(i, min(i + step, page_count)) for i in range(0, page_count, step)]
+    try:
+        with ProcessPoolExecutor(
+            max_workers=len(chunks),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(data,),
+        ) as executor:
+            texts = [
+                text for chunk in executor.map(_extract_pages, chunks) for text in chunk
+            ]
+    finally:
+        _pool_lock.release()
+    return "\n".join(texts)
+
+
+def extract_pdf_text(data) -> str:
+    """
+    Извлекает текст из PDF: через PDFium, а при ошибке — через pypdf.
+
+    Args:
+        data: Содержимое PDF-файла.
+
+    Returns:
+        str: Текст всех страниц, разделенный переносами строк.
+    """
+    data = bytes(data)
+    try:
+        return extract_pdfium_text(data)
+    except pdfium.PdfiumError as e:
+        logging.warning(f"PDFium не смог прочитать файл, используется pypdf: {str(e)}")
+        return extract_pypdf_text(data)